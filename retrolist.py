@@ -1,23 +1,103 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
 """Generate a romset and play list for a given system and rom collection"""
 
 import sys
-from os import listdir, chdir, getcwd, makedirs
-from os.path import isfile, join, basename, exists
+from os import scandir, makedirs, fstat, cpu_count
+from os.path import join, basename, exists, abspath, getmtime, getsize, splitext
 import zipfile
-import xml.etree.ElementTree as ET
-import array
 import time
 import argparse
 import logging
 import io
-import cPickle
+import pickle
+import gzip
 import hashlib
-import crcmod
+import shutil
+from collections import namedtuple
+import mmap
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import py7zlib
 
+try:
+    from os import posix_fadvise, POSIX_FADV_SEQUENTIAL
+except ImportError:
+    posix_fadvise = None
+
+try:
+    from fastcrc import crc32 as fastcrc32
+
+    def crc32(data, value=0):
+        """Compute the CRC32 of a block, continuing from a previous value"""
+        return fastcrc32.iso_hdlc(data, value)
+except ImportError:
+    from zlib import crc32
+
+try:
+    from lxml import etree as ET
+
+    # only the elements read by load_database are reported while parsing
+    ITERPARSE_ARGS = {'tag': ('header', 'game')}
+except ImportError:
+    import xml.etree.ElementTree as ET
+    ITERPARSE_ARGS = {}
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+# files larger than this are mapped in memory instead of read in chunks
+MMAP_THRESHOLD = 64 * 1024
+
+# word types used to byte swap n64 roms
+N64_DTYPES = {'H': np.uint16, 'I': np.uint32}
+
+# blocks of at least this size are byte swapped by the numba kernels when available
+NUMBA_THRESHOLD = 1024 * 1024
+
+# n64 roms are byte swapped and checksummed in blocks of this size, small enough to stay in cache
+SWAP_CRC_BLOCK = 256 * 1024
+
+# files that can't be mapped in memory are read in blocks of this size
+READ_BLOCK = 1024 * 1024
+
+# size of the iNES header, not included in the rom checksum
+INES_HEADER_SIZE = 16
+
+# rom header types by their first four bytes, with the word type used to correct n64 roms
+ROM_HEADERS = {
+    b"\x4e\x45\x53\x1a": ('ines', None), # "NES^Z"
+    b"\x80\x37\x12\x40": ('z64', 'H'),
+    b"\x40\x12\x37\x80": ('n64', 'I'),
+    b"\x37\x80\x40\x12": ('v64', None),
+}
+
+# rom header types whose checksum differs from the checksum of the file content
+CRC_DEPENDENT_HEADERS = ('ines', 'z64', 'n64')
+
+# a game entry in the database, with its release regions and its (crc, name, size) roms
+GameInfo = namedtuple('GameInfo', ['name', 'cloneof', 'regions', 'roms'])
+
+# systems whose rom checksums are not computed over the plain file content
+CONTENT_CRC_SYSTEMS = ('Nintendo - Nintendo Entertainment System', 'Nintendo - Nintendo 64')
+
+# compression methods for the romset archives, see create_romset
+COMPRESSION_METHODS = {'stored': zipfile.ZIP_STORED, 'deflated': zipfile.ZIP_DEFLATED, \
+    'bzip2': zipfile.ZIP_BZIP2, 'lzma': zipfile.ZIP_LZMA}
+
+# file extensions of the supported archives
+ARCHIVE_EXTENSIONS = ('.zip', '.7z')
+
+# database indexes built by load_database
+DatabaseIndex = namedtuple('DatabaseIndex', \
+    ['crc_to_game', 'name_to_game', 'game_region_idx', 'rom_sizes', 'content_crc'])
+
+# database checksums and sizes used to skip files early, see crc_archive
+CrcFilter = namedtuple('CrcFilter', ['crc_keys', 'rom_sizes', 'content_crc'])
+
 
 def display_message(text):
     """Display message in the standard output"""
@@ -34,7 +114,7 @@ def display_step(text, value):
 def display_progress(text, index, total, length=40):
     """Display a progress bar for a process"""
     index += 1
-    bar_progress = length*index/total
+    bar_progress = length*index//total
     bar_remaining = length-bar_progress
     text = '\r{0}:\t[{1}] ({2}/{3})'.format(text, '#'*bar_progress+'-'*bar_remaining, index, total)
     display_message(text)
@@ -46,71 +126,150 @@ def is_game_name(name):
     """ Identifies a Beta, BIOS, Prototype game """
     return any(s in name for s in ['[BIOS]', '(Proto)', '(SDK Build)'])
 
-def is_ines(header):
-    """ Detects whether this is a iNES rom """
-    if header[:4] == "\x4e\x45\x53\x1a": # "NES^Z"
-        logging.debug('(nes) %dx16kB ROM, %dx8kB VROM', ord(header[5]), ord(header[6]))
-        return True
-    return False
+def rom_header(header):
+    """ Detects the rom header type, see ROM_HEADERS
+
+    Returns:
+        tuple: the header type and the word type used to correct the rom, or (None, None)
+    """
+    (kind, swap) = ROM_HEADERS.get(bytes(header[:4]), (None, None))
+    if kind == 'ines':
+        logging.debug('(nes) %dx16kB ROM, %dx8kB VROM', header[4], header[5])
+    elif kind is not None:
+        logging.debug('(n64) detected .' + kind)
+    return (kind, swap)
+
+
+def is_zip(header):
+    """Detect a zip archive"""
+    return header[:4] == b"PK\x03\x04"
+
+
+def is_7z(header):
+    """Detect a 7z archive"""
+    return header[:6] == b"7z\xbc\xaf\x27\x1c"
 
 
-def is_n64(header):
-    """Detect a n64 file type"""
-    if header[:4] == "\x40\x12\x37\x80":
-        logging.debug('(n64) detected .n64')
-        exit(2)
-        return True
-    return False
+def is_crc_dependent(header):
+    """Detect whether the checksum of a rom differs from the checksum of its file content"""
+    return rom_header(header)[0] in CRC_DEPENDENT_HEADERS or is_zip(header) or is_7z(header)
 
 
-def is_z64(header):
-    """Detect a z64 file type"""
-    if header[:4] == "\x80\x37\x12\x40":
-        logging.debug('(n64) detected .z64')
-        return True
-    return False
+def is_archive_name(fname):
+    """Check whether a file name has an archive extension"""
+    return splitext(fname)[1].lower() in ARCHIVE_EXTENSIONS
 
 
-def is_v64(header):
-    """Detect a v64 file type"""
-    if header[:4] == "\x37\x80\x40\x12":
-        logging.debug('(n64) detected .v64')
-        return True
-    return False
+def is_rom_size(size, rom_sizes):
+    """Check whether a file size matches a rom size, allowing for an iNES header"""
+    return size in rom_sizes or size - INES_HEADER_SIZE in rom_sizes
+
+
+if njit is not None:
+    # the kernels are compiled on first use, when create_romset corrects a n64 rom after the
+    # verification workers are done, compiling them on import starts the numba threading
+    # layer before the workers are forked, which deadlocks them
+    @njit(parallel=True, cache=True)
+    def swap16(src, dst):
+        """Byte swap the 16 bit words of a buffer into another"""
+        for i in prange(src.size // 2):
+            dst[2*i] = src[2*i+1]
+            dst[2*i+1] = src[2*i]
+
+    @njit(parallel=True, cache=True)
+    def swap32(src, dst):
+        """Byte swap the 32 bit words of a buffer into another"""
+        for i in prange(src.size // 4):
+            dst[4*i] = src[4*i+3]
+            dst[4*i+1] = src[4*i+2]
+            dst[4*i+2] = src[4*i+1]
+            dst[4*i+3] = src[4*i]
+
+    N64_KERNELS = {'H': swap16, 'I': swap32}
+else:
+    N64_KERNELS = None
 
 
 def n64_correct(bytelist, swap):
     """Correct a n64 file block"""
-    buf = array.array(swap, bytelist)
-    buf.byteswap()
-    return buf.tostring()
+    if N64_KERNELS is not None and len(bytelist) >= NUMBA_THRESHOLD:
+        src = np.frombuffer(bytelist, dtype=np.uint8)
+        dst = np.empty_like(src)
+        N64_KERNELS[swap](src, dst)
+        return dst.tobytes()
+    return np.frombuffer(bytelist, dtype=N64_DTYPES[swap]).byteswap().tobytes()
+
+
+def crc_n64(bytelist, swap, crc_value=0):
+    """Compute the CRC32 of a n64 file block, correcting it one cache sized block at a time"""
+    words = np.frombuffer(bytelist, dtype=N64_DTYPES[swap])
+    step = SWAP_CRC_BLOCK // words.itemsize
+    for pos in range(0, words.size, step):
+        crc_value = crc32(words[pos:pos+step].byteswap(), crc_value)
+    return crc_value
+
+
+def map_file(fobj, size=None):
+    """ Maps a file object in memory if it is backed by a large enough file
+
+    Args:
+        fobj(file): the file object
+        size(int): the file size if already known
+
+    Returns:
+        mmap.mmap: a read only mapping of the whole file, or None if not suitable
+    """
+    try:
+        fileno = fobj.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
 
+    if size is None:
+        size = fstat(fileno).st_size
+    if size <= MMAP_THRESHOLD:
+        return None
 
-def crc_file(fobj):
-    """ Computes CRC32 for a file object """
+    if posix_fadvise is not None:
+        posix_fadvise(fileno, 0, 0, POSIX_FADV_SEQUENTIAL)
+    return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
 
-    hash_crc = crcmod.Crc(0x104c11db7, initCrc=0, xorOut=0xFFFFFFFF)
+
+def crc_file(fobj, size=None):
+    """ Computes CRC32 for a file object, optionally given the file size """
+
+    crc_value = 0
     header = fobj.read(16)
 
-    swap = None
-    if is_z64(header):
-        swap = "H"
-    elif is_n64(header):
-        swap = "I"
-    elif is_v64(header):
-        logging.debug('(n64) no correction required')
+    (kind, swap) = rom_header(header)
 
     # ines detection, skip 16 first bytes
-    if not is_ines(header):
+    start = INES_HEADER_SIZE if kind == 'ines' else 0
+
+    # large files are computed in one shot over the mapped file
+    fmap = map_file(fobj, size)
+    if fmap is not None:
+        with fmap, memoryview(fmap) as view:
+            if swap is not None:
+                crc_value = crc_n64(view[start:], swap)
+            else:
+                crc_value = crc32(view[start:])
+        return f'{crc_value:08X}'
+
+    if not start:
         if swap is not None:
-            header = n64_correct(header, swap)
-        hash_crc.update(header)
+            crc_value = crc_n64(header, swap, crc_value)
+        else:
+            crc_value = crc32(header, crc_value)
 
-    for chunk in iter(lambda: fobj.read(4096), b""):
-        if swap is not None:
-            chunk = n64_correct(chunk, swap)
-        hash_crc.update(chunk)
-    return hash_crc.hexdigest()
+    # stream the rest of the file through a single reusable buffer
+    buf = bytearray(READ_BLOCK)
+    with memoryview(buf) as view:
+        for length in iter(lambda: fobj.readinto(buf), 0):
+            if swap is not None:
+                crc_value = crc_n64(view[:length], swap, crc_value)
+            else:
+                crc_value = crc32(view[:length], crc_value)
+    return f'{crc_value:08X}'
 
 
 def crc(fname):
@@ -130,7 +289,46 @@ def crc(fname):
         return crc_file(fobj)
 
 
-def verify_file(fname, rompath, crc_res, dbroot, pname_candidate, region_preference, include_bios):
+def candidate_priority(candidate):
+    """ Sorts a (game, fname, crc, index) candidate by region priority, then parents before
+    clones, then by game name """
+    (game, _, _, index) = candidate
+    return (index, game.cloneof is not None, game.name)
+
+
+def reduce_candidate(current, new):
+    """ Selects the preferred of two (game, fname, crc, index) candidates for the same parent game
+
+    The candidate with a release in the region of highest priority is preferred, ties are broken
+    in favor of the parent game and then by game name, so the result doesn't depend on the order
+    the files are verified in. For the same game the current candidate is kept.
+
+    Args:
+        current(tuple): the current candidate, or None if there is none yet
+        new(tuple): the new candidate, with the index of its best region
+
+    Returns:
+        tuple: the preferred candidate
+    """
+    (game, _, _, _) = new
+
+    # check if the there is no candidate already, add one
+    if current is None:
+        logging.debug('(crc) - added candidate: ' + game.name)
+        return new
+
+    # this candidate has less priority
+    (current_game, _, _, _) = current
+    if candidate_priority(new) >= candidate_priority(current):
+        logging.debug('(crc) - inferior priority, ignoring candidate: %s', game.name)
+        return current
+
+    # replace the current candidate
+    logging.debug('(crc) - replaces candidate: %s', current_game.name)
+    return new
+
+
+def verify_file(fname, rompath, crc_res, dbindex, pname_candidate, region_preference, include_bios):
     """ Verifies that a file with a given CRC32 checksum matches a game entry in the database
 
     This function check that a given file name matches a corresponding entry to its given CRC32
@@ -140,23 +338,24 @@ def verify_file(fname, rompath, crc_res, dbroot, pname_candidate, region_prefere
     Args:
         fname(str): the file path
         rompath(str): the directory name
-        crc_res(str): a hexadecimal string with a valid CRC32 checksum
-        root(xml.etree.ElementTree): the parent/clone game database
+        crc_res(str): an upper case hexadecimal string with a valid CRC32 checksum
+        dbindex(DatabaseIndex): the database indexes as returned by load_database
         pname_candidate(dict): a dict with key 'parent game name' and value
-            the triplet (game, fname, crc) of the current candidate
+            the tuple (game, fname, crc, index) of the current candidate, where index is
+            the priority of its best region
 
     Returns:
         nothing
     """
 
     # check if the game has a crc checksum associated
-    game = dbroot.find('.//rom[@crc="' + crc_res + '"]/..')
+    game = dbindex.crc_to_game.get(crc_res)
     if game is None:
         logging.debug('(crc) not found! path: %s, crc: %s', fname, crc_res)
         return
 
     # extract the file name
-    game_name = game.attrib['name']
+    game_name = game.name
     logging.debug('(crc) file matches game: ' + game_name)
     fpath = join(rompath, fname)
 
@@ -166,90 +365,96 @@ def verify_file(fname, rompath, crc_res, dbroot, pname_candidate, region_prefere
         return
 
     # check if it's a clone, set the parent accordingly
-    if 'cloneof' in game.attrib:
-        parent = dbroot.find('.//game[@name="' + game.attrib['cloneof'] + '"]')
-        logging.debug('(crc) - parent: ' + parent.attrib['name'])
+    if game.cloneof is not None:
+        parent = dbindex.name_to_game[game.cloneof]
+        logging.debug('(crc) - parent: ' + parent.name)
     else:
         parent = game
 
     # check if the new candidate has a release, skip if not
-    new_regions = [r.attrib['region'] for r in game.findall('.//release')]
-    if not len(new_regions):
+    new_regions = game.regions
+    if not new_regions:
         logging.debug('(crc) - no regions to compare! (and there is already a candidate)')
         return
 
-    # list supported regions for candidate
+    # check the candidate has a supported region
+    new_index = dbindex.game_region_idx[game_name]
     if region_preference:
-        isect_regions = list(set(new_regions) & set(region_preference))
-        if not len(isect_regions):
+        if new_index == sys.maxsize:
             logging.debug('(crc) - no supported regions!')
             return
-        logging.debug('(crc) - regions supported: %s', ', '.join(isect_regions))
+        logging.debug('(crc) - best region supported: %s', region_preference[new_index])
     else:
-        isect_regions = new_regions
-        logging.debug('(crc) - regions available: %s', ', '.join(isect_regions))
+        logging.debug('(crc) - regions available: %s', ', '.join(new_regions))
 
-    # check if the there is no candidate already, add one
+    # keep the preferred candidate for the parent game
     # note: we only add a candidate that contains a acceptable release
-    parent_name = parent.attrib['name']
-    if parent_name not in pname_candidate:
-        pname_candidate[parent_name] = (game, fpath, crc_res)
-        logging.debug('(crc) - added candidate: ' + game_name)
-        return
-
-    # if we don't filter regions, we always take the first candidate
-    if not len(region_preference):
-        logging.debug('(crc) - no region set specified, ignoring candidate: %s', game_name)
-        return
+    current = pname_candidate.get(parent.name)
+    pname_candidate[parent.name] = reduce_candidate(current, (game, fpath, crc_res, new_index))
 
-    # get lowest index for region in new candidate
-    new_index = reduce(min, [region_preference.index(r) for r in isect_regions])
 
-    # get supported regions for the current candidate
-    (current_game, _, _) = pname_candidate[parent_name]
-    current_releases = current_game.findall('.//release')
-    current_regions = [r.attrib['region'] for r in current_releases if r in region_preference]
-
-    # get the priority of the current region
-    current_priorities = [region_preference.index(r) for r in current_regions] + [sys.maxsize]
-    current_index = reduce(min, current_priorities)
-
-    # this candidate has less priority
-    if new_index >= current_index:
-        logging.debug('(crc) - inferior region priority, ignoring candidate: %s', game_name)
-        return
-
-    # replace the current candidate
-    logging.debug('(crc) - replaces candidate: %s', current_game.attrib['name'])
-    pname_candidate[parent_name] = (game, fpath, crc_res)
+def release_element(elem):
+    """ Frees a parsed element, and with lxml also the already released elements before it """
+    elem.clear()
+    if hasattr(elem, 'getprevious'):
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
 
 
 def load_database(dbpath, region_priority, region_filter):
     """ Loads a parent/clone xml dat-o-matic type database
 
+    The database is parsed in a single streaming pass, keeping only the game information
+    needed to verify the roms and discarding the XML elements as soon as they are read.
+
     Args:
         dbpath(str): the database file path
 
     Returns:
-        xml.etree.ElementTree: the root of the parsed XML tree
+        str: the name of the database
         list: a list of supported regions sorted by priority
+        DatabaseIndex: the database indexes, dicts mapping the rom crc and the game name to
+            the game information, the game name to the index of its best region in the list
+            of supported regions, the set of rom sizes, and whether the rom checksums of
+            the system need to be computed over the file content (see CONTENT_CRC_SYSTEMS)
     """
 
-    # read the database file
-    display_step('load dat', args.database)
-    tree = ET.parse(dbpath)
-    root = tree.getroot()
+    # read the database file, indexing the games by name and by rom crc
+    display_step('load dat', dbpath)
+    dat_name = None
+    dat_desc = None
+    crc_to_game = dict()
+    name_to_game = dict()
+    rom_sizes = set()
+    for _, elem in ET.iterparse(dbpath, events=('end',), **ITERPARSE_ARGS):
+        if elem.tag == 'header':
+            dat_name = elem.findtext('name')
+            dat_desc = elem.findtext('description')
+        elif elem.tag == 'game':
+            regions = tuple(r.attrib['region'] for r in elem.findall('release'))
+            # the crc and size are optional, e.g. for nodump roms, which can't be matched
+            roms = tuple((r.get('crc').upper(), r.get('name'), \
+                int(r.get('size')) if r.get('size') else None) \
+                for r in elem.findall('rom') if r.get('crc'))
+            game = GameInfo(elem.attrib['name'], elem.get('cloneof'), regions, roms)
+            name_to_game[game.name] = game
+            for (rom_crc, _, rom_size) in roms:
+                # a checksum shared by several games matches the first one in the database
+                crc_to_game.setdefault(rom_crc, game)
+                if rom_size is not None:
+                    rom_sizes.add(rom_size)
+            release_element(elem)
 
     # extract some useful information
-    games = root.findall('game')
-    clones = root.findall('game[@cloneof]')
-    region_list = sorted(set([x.attrib['region'] for x in root.findall('.//release')]))
-    bios = [game for game in game if not is_game_name(game.attrib['name'])]
+    games = list(name_to_game.values())
+    clones = [game for game in games if game.cloneof is not None]
+    region_list = sorted({r for game in games for r in game.regions})
+    bios = [game for game in games if is_game_name(game.name)]
 
     # display some debug info
     logging.debug('(xml) path: %s', dbpath)
-    logging.debug('(xml) - name: %s', root.find('.//header/name').text)
-    logging.debug('(xml) - desc: %s', root.find('.//header/description').text)
+    logging.debug('(xml) - name: %s', dat_name)
+    logging.debug('(xml) - desc: %s', dat_desc)
     logging.debug('(xml) - games: total %d (%d parent / %d clones)', \
         len(games), len(games)-len(clones), len(clones))
     logging.debug('(xml) - regions: total %d (%s)', len(region_list), ', '.join(region_list))
@@ -257,141 +462,272 @@ def load_database(dbpath, region_priority, region_filter):
 
     # add regions not in the priority list but present in the data set
     if len(region_priority):
-        region_list = region_priority + list(set(region_list) - set(region_priority))
+        region_list = region_priority + [r for r in region_list if r not in region_priority]
         logging.debug('(xml) - priority: %s', ', '.join(region_list))
 
     # remove filtered regions from the priority list
     if len(region_filter):
-        region_list = list(set(region_list) & set(region_filter))
+        region_list = [r for r in region_list if r in region_filter]
         logging.debug('(xml) - filter: %s', ', '.join(region_list))
 
-    return root, region_list
+    # precompute the best region priority for each game
+    region_idx = {region: idx for idx, region in enumerate(region_list)}
+    game_region_idx = dict()
+    for game in games:
+        game_region_idx[game.name] = min((region_idx[r] for r in game.regions if r in region_idx), \
+            default=sys.maxsize)
 
+    # the checksums stored in archives can be trusted unless the system corrects the content
+    content_crc = dat_name is None or dat_name.startswith(CONTENT_CRC_SYSTEMS)
+    logging.debug('(xml) - content checksum: %s', content_crc)
 
-def verify_archive(fname, fp, dbroot, regions, bios_filter, rompath, pname_candidate):
-    logging.debug('(arc) verifying: ' + fname)
+    dbindex = DatabaseIndex(crc_to_game, name_to_game, game_region_idx, rom_sizes, content_crc)
+    return dat_name, region_list, dbindex
 
-    try:
-        zfile = zipfile.ZipFile(fp)
-        logging.debug('(zip) zip archive detected')
-        for zipinfo in zfile.infolist():
-            logging.debug('(zip) filename: ' + zipinfo.filename)
-            logging.debug('(zip) - digest: {:X}'.format(zipinfo.CRC))
-            with io.BytesIO(zfile.read(zipinfo)) as new_fp:
-                new_fname = fname + '#' + zipinfo.filename
-                verify_archive(new_fname, new_fp, dbroot, regions, bios_filter, rompath, pname_candidate)
-
-    except zipfile.BadZipfile:
-        pass
-        #logging.debug('(zip) not a zip file')
 
+def crc_archive(fname, fp, crc_filter, size=None):
+    """ Computes the CRC32 for a file and, if it is an archive, for each of its members
+
+    Files and archive members that can't match any rom in the database, either by their
+    size or by the checksum stored in the archive, are skipped without computing the CRC32.
+    Unless the system needs the checksum of the file content, the checksum stored in the
+    archive is used without extracting the member.
+
+    Args:
+        fname(str): the file name, members are named as 'archive#member'
+        fp(file): the file object
+        crc_filter(CrcFilter): the database checksums and sizes
+        size(int): the file size if already known
+
+    Returns:
+        list: a list of (fname, crc) tuples
+    """
+    logging.debug('(arc) verifying: ' + fname)
+    crc_list = []
+
+    # detect the archive type by its signature
+    magic = fp.read(6)
     fp.seek(0)
-    try:
-        ar7z = py7zlib.Archive7z(fp)
-        logging.debug('(p7z) 7z archive detected')
-        for fp7z in ar7z.getmembers():
-            logging.debug('(p7z) filename: ' + fp7z.filename)
-            logging.debug('(p7z) - digest: {:X}'.format(fp7z.digest))
-            with io.BytesIO(fp7z.read()) as new_fp:
-                new_fname = fname + '#' + fp7z.filename
-                verify_archive(fname, new_fp, dbroot, regions, bios_filter, rompath, pname_candidate)
-
-    except py7zlib.FormatError:
-        pass
-        #logging.debug('(p7z) not a 7z file')
+
+    if is_zip(magic):
+        try:
+            zfile = zipfile.ZipFile(fp)
+            logging.debug('(zip) zip archive detected')
+            for zipinfo in zfile.infolist():
+                logging.debug('(zip) filename: ' + zipinfo.filename)
+                logging.debug('(zip) - digest: {:X}'.format(zipinfo.CRC))
+                new_fname = f'{fname}#{zipinfo.filename}'
+                zip_crc = f'{zipinfo.CRC:08X}'
+                is_archive = is_archive_name(zipinfo.filename)
+
+                # neither the stored checksum nor the size can match, don't decompress the header
+                if not is_archive and zip_crc not in crc_filter.crc_keys \
+                    and not is_rom_size(zipinfo.file_size, crc_filter.rom_sizes):
+                    logging.debug('(zip) - digest and size not found, skipping')
+                    continue
+
+                header = None
+                if crc_filter.content_crc or is_archive:
+                    with zfile.open(zipinfo) as new_fp:
+                        header = new_fp.read(16)
+
+                # only nested archives are extracted in memory, as they need to be seekable
+                if header is not None and (is_zip(header) or is_7z(header)):
+                    with io.BytesIO(zfile.read(zipinfo)) as new_fp:
+                        crc_list.extend(crc_archive(new_fname, new_fp, crc_filter))
+                    continue
+
+                # the stored checksum is the rom checksum unless the content needs correction
+                if header is None or not is_crc_dependent(header):
+                    if zip_crc in crc_filter.crc_keys:
+                        crc_list.append((new_fname, zip_crc))
+                    else:
+                        logging.debug('(zip) - digest not found, skipping')
+                    continue
+
+                if not is_rom_size(zipinfo.file_size, crc_filter.rom_sizes):
+                    logging.debug('(zip) - size not found: %d, skipping', zipinfo.file_size)
+                    continue
+
+                # stream the member through the checksum without extracting it
+                with zfile.open(zipinfo) as new_fp:
+                    crc_list.append((new_fname, crc_file(new_fp, zipinfo.file_size)))
+
+        except zipfile.BadZipFile:
+            logging.debug('(zip) invalid zip archive: ' + fname)
+        return crc_list
+
+    if is_7z(magic):
+        try:
+            ar7z = py7zlib.Archive7z(fp)
+            logging.debug('(p7z) 7z archive detected')
+            for fp7z in ar7z.getmembers():
+                logging.debug('(p7z) filename: ' + fp7z.filename)
+                new_fname = f'{fname}#{fp7z.filename}'
+                p7z_crc = None if fp7z.digest is None else f'{fp7z.digest:08X}'
+                logging.debug('(p7z) - digest: %s', p7z_crc)
+                is_archive = is_archive_name(fp7z.filename)
+
+                # neither the stored digest nor the size can match, don't decompress the member
+                if not is_archive and p7z_crc not in crc_filter.crc_keys \
+                    and not is_rom_size(fp7z.size, crc_filter.rom_sizes):
+                    logging.debug('(p7z) - digest and size not found, skipping')
+                    continue
+
+                # the stored digest is the rom checksum unless the system corrects the content
+                if not crc_filter.content_crc and p7z_crc is not None and not is_archive:
+                    if p7z_crc in crc_filter.crc_keys:
+                        crc_list.append((new_fname, p7z_crc))
+                    else:
+                        logging.debug('(p7z) - digest not found, skipping')
+                    continue
+
+                # py7zlib returns an empty str for empty members
+                with io.BytesIO(fp7z.read() or b'') as new_fp:
+                    crc_list.extend(crc_archive(new_fname, new_fp, crc_filter))
+
+        except py7zlib.FormatError:
+            logging.debug('(p7z) invalid 7z archive: ' + fname)
+        return crc_list
+
+    # skip files with no matching rom size
+    if size is None:
+        fp.seek(0, io.SEEK_END)
+        size = fp.tell()
+    if not is_rom_size(size, crc_filter.rom_sizes):
+        logging.debug('(rom) size not found: %d, skipping', size)
+        return crc_list
 
     # for iNES the computed CRC differs
     fp.seek(0)
-    crc_res = crc_file(fp)
-    verify_file(fname, rompath, crc_res, dbroot, pname_candidate, regions, bios_filter)
+    crc_list.append((fname, crc_file(fp, size)))
+    return crc_list
 
 
-def verify_paths(path_list, dbroot, region_l, bios_filter):
-    """ Verifies a list of paths for valid ROMS against a database
+# database checksums and sizes for the worker processes, see init_worker
+WORKER_CRC_FILTER = None
+
+
+def init_worker(crc_filter):
+    """ Initializes a worker process with the database checksums and sizes """
+    global WORKER_CRC_FILTER
+    WORKER_CRC_FILTER = crc_filter
+
+
+def crc_path(entry):
+    """ Computes the CRC32 for a (rompath, fname, size) file, see crc_archive """
+    (rompath, fname, size) = entry
+    logging.debug('(rom) checking for archive: ' + fname)
+    with open(join(rompath, fname), 'rb') as fobj:
+        return crc_archive(fname, fobj, WORKER_CRC_FILTER, size)
+
+
+def list_files(path):
+    """ Lists the regular files in a directory, largest first
 
     Args:
-        path_list(list): a list of directories
-        dbroot(ElementTree): the root of the parsed XML tree
+        path(str): the directory
 
     Returns:
-        dict: a dictionary with the candidate (game, fname, crc) for each game found
+        list: a list of (fname, size) tuples sorted by descending size, then by name
     """
+    with scandir(path) as dir_entries:
+        entries = [(entry.name, entry.stat().st_size) for entry in dir_entries if entry.is_file()]
+    entries.sort(key=lambda entry: (-entry[1], entry[0]))
+    return entries
 
-    candidate_dict = dict()
-    for rompath in path_list:
-        display_step('check path', rompath)
 
-        # lists all files within the directory
-        logging.debug('(rom) loading roms from path: ' + rompath)
+def verify_paths(path_list, dbindex, region_l, bios_filter):
+    """ Verifies a list of paths for valid ROMS against a database
 
-        # save current directory, change to the next one
-        cwd = getcwd()
-        chdir(rompath)
+    The checksums are computed in parallel by a pool of worker processes, while the
+    results are matched against the database in order by the main process.
 
-        filelist = filter(isfile, listdir('.'))
-        for idx, fname in enumerate(filelist):
-            display_progress("verify path", idx, len(filelist))
+    Args:
+        path_list(list): a list of directories
+        dbindex(tuple): the database indexes as returned by load_database
 
-            # check for archive file
-            logging.debug('(rom) checking for archive: ' + fname)
-            with open(fname) as fobj:
-                verify_archive(fname, fobj, dbroot, region_l, bios_filter, rompath, candidate_dict)
+    Returns:
+        dict: a dictionary with the candidate (game, fname, crc, index) for each game found
+    """
 
-        # return to previous directory
-        chdir(cwd)
+    candidate_dict = dict()
+    crc_filter = CrcFilter(frozenset(dbindex.crc_to_game), frozenset(dbindex.rom_sizes), \
+        dbindex.content_crc)
+    with ProcessPoolExecutor(max_workers=cpu_count(), initializer=init_worker, \
+        initargs=(crc_filter,)) as executor:
+        for rompath in path_list:
+            display_step('check path', rompath)
+
+            # lists all files within the directory
+            logging.debug('(rom) loading roms from path: ' + rompath)
+
+            # the largest files are submitted first to balance the load of the workers
+            filelist = [(rompath, fname, size) for fname, size in list_files(rompath)]
+            crc_results = executor.map(crc_path, filelist)
+            for idx, crc_list in enumerate(crc_results):
+                display_progress("verify path", idx, len(filelist))
+                for fname, crc_res in crc_list:
+                    verify_file(fname, rompath, crc_res, dbindex, candidate_dict, region_l, bios_filter)
 
     return candidate_dict
 
 
-def generate_playlist(candidate_dict, playlist, file_prefix):
+def generate_playlist(candidate_dict, pnames, playlist, file_prefix):
     """ Generates a Retroarch compatible playlist
 
     Args:
         candidate_dict(dict): a dictionary containing a romset
+        pnames(list): the parent game names in the romset, in playlist order
         playlist(string): the playlist file path
         file_prefix(string): the base path for games in the playlist
 
     """
-    with open(playlist, 'w') as fobj:
-        logging.debug('(lpl) creating playlist: ' + playlist)
-        for idx, pname in enumerate(sorted(pname_candidate)):
-            display_progress("create plist", idx, len(pname_candidate))
+    logging.debug('(lpl) creating playlist: ' + playlist)
+    entries = []
+    for idx, pname in enumerate(pnames):
+        display_progress("create plist", idx, len(pnames))
 
-            # retrieve game path and crc for a game
-            (_, path, file_crc) = candidate_dict[pname]
-            if file_prefix:
-                path = join(file_prefix, basename(path))
+        # retrieve game path and crc for a game
+        (_, path, file_crc, _) = candidate_dict[pname]
+        if file_prefix:
+            path = join(file_prefix, basename(path))
 
-            # append new entry to the playlist
-            logging.debug('(lpl) - adding game: %s', pname)
-            entry = "{}\n{}\nDETECT\nDETECT\n{}|crc\n{}\n".format(path, pname, file_crc, playlist)
-            fobj.write(entry)
+        # append new entry to the playlist
+        logging.debug('(lpl) - adding game: %s', pname)
+        entries.append(f'{path}\n{pname}\nDETECT\nDETECT\n{file_crc}|crc\n{playlist}\n')
 
+    # write the whole playlist at once
+    with open(playlist, 'w') as fobj:
+        fobj.write(''.join(entries))
 
-def create_romset(pname_candidate, dest='.'):
-    """ Creates a romset out of a the games found and matched """
-    for idx, pname in enumerate(sorted(pname_candidate)):
-        display_progress("create romset", idx, len(pname_candidate))
 
-        (game, path, crc) = pname_candidate[pname]
+def create_romset(pname_candidate, pnames, dest='.', compression=zipfile.ZIP_STORED):
+    """ Creates a romset out of a the games found and matched, for the given parent names
+
+    Each rom is streamed into its own archive, named after the game, with the given zipfile
+    compression method. Roms are mostly incompressible, so they are stored by default.
+    """
+    for idx, pname in enumerate(pnames):
+        display_progress("create romset", idx, len(pnames))
+
+        (game, path, crc, _) = pname_candidate[pname]
 
         # retrieve the rom and game name
-        rom = game.find('./rom[@crc="' + crc + '"]')
-        rname = rom.attrib['name']
-        gname = game.attrib['name']
-        size = rom.attrib['size']
+        (_, rname, size) = next(rom for rom in game.roms if rom[0] == crc)
+        gname = game.name
 
         logging.debug('(set) processing game: ' + gname)
         logging.debug('(set) - rom: ' + rname) 
         logging.debug('(set) - crc: ' + crc) 
-        logging.debug('(set) - size: ' + size) 
+        logging.debug('(set) - size: %s', size)
         logging.debug('(set) - path: ' + path)
 
         # check if the file is inside of a zip
         path_split = path.split('.zip#')
         if len(path_split) == 1:
             # open the file
-            fo = open(path)
+            fo = open(path, 'rb')
         else:
             # open the zip and the file
             zo = zipfile.ZipFile(path_split[0] + '.zip', mode='r')
@@ -400,33 +736,25 @@ def create_romset(pname_candidate, dest='.'):
         # create a zip file in the destination directory with the rom name
         zip_path = join(dest, gname + '.zip')
         logging.debug('(set) - archive: ' + zip_path)
-        zf = zipfile.ZipFile(zip_path, mode='w')
 
         # use the rom name from the dat file also for the zipped file
         zi = zipfile.ZipInfo(rname)
         zi.date_time = time.localtime(time.time())[:6]
-        zi.compress_type = zipfile.ZIP_DEFLATED
-
-        # read whole file in memory (zip doesn't like appending)
-        fstr = fo.read()
-
-        # convert format for n64
-        swap = None
-        if is_z64(fstr[:8]):
-            swap = "H"
-        elif is_n64(fstr[:8]):
-            swap = "I"
-        elif is_v64(fstr[:8]):
-            logging.debug('(n64) - no correction required')
-
-        if swap is not None:
-            fstr = n64_correct(fstr, swap)
-            logging.debug('(n64) - file corrected!')
+        zi.compress_type = compression
 
-        # write file
+        # stream the file into the archive, converting the format for n64 a block at a time
         logging.debug('(set) - adding game: ' + gname)
-        zf.writestr(zi, fstr)
-        zf.close()
+        with fo, zipfile.ZipFile(zip_path, mode='w') as zf, zf.open(zi, mode='w') as zfo:
+            header = fo.read(16)
+            (_, swap) = rom_header(header)
+            if swap is None:
+                zfo.write(header)
+                shutil.copyfileobj(fo, zfo, READ_BLOCK)
+            else:
+                zfo.write(n64_correct(header, swap))
+                for block in iter(lambda: fo.read(READ_BLOCK), b""):
+                    zfo.write(n64_correct(block, swap))
+                logging.debug('(n64) - file corrected!')
         logging.debug('(set) - archive closed correctly')
 
 
@@ -442,6 +770,10 @@ if __name__ == '__main__':
     __parser__.add_argument('-r', '--romdir', \
         help='create a romset in the specified directory with the game set', \
         action='store_true')
+    __parser__.add_argument('-c', '--compression', \
+        help='the compression method of the romset archives', \
+        choices=list(COMPRESSION_METHODS), \
+        default='stored')
     __parser__.add_argument('-l', '--playlist', \
         help='create a playlist file with the game set', \
         action='store_true')
@@ -461,6 +793,7 @@ if __name__ == '__main__':
         action='store_true')
     __parser__.add_argument('--verbose', '-v', \
         action='count', \
+        default=0, \
         help='display verbose output')
     args = __parser__.parse_args()
 
@@ -469,34 +802,41 @@ if __name__ == '__main__':
         logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
 
      # load the database and compute the checksum for the given paths
-    xml_root, regions = load_database(args.database, args.priority, args.filter)
+    dat_name, regions, db_index = load_database(args.database, args.priority, args.filter)
 
-    # compute checksum
+    # compute checksum, the cache is invalidated whenever the database file changes
     pname_candidate = None
-    arguments = [args.database, args.rompath, args.priority, args.filter, args.bios]
-    cache_filename = '/tmp/' + hashlib.md5(cPickle.dumps(arguments)).hexdigest() + '.cache'
+    arguments = (abspath(args.database), getmtime(args.database), getsize(args.database), \
+        tuple(args.rompath), tuple(args.priority), tuple(args.filter), bool(args.bios))
+    cache_digest = hashlib.blake2b(repr(arguments).encode(), digest_size=16).hexdigest()
+    cache_filename = f'/tmp/retrolist-{cache_digest}.cache'
     try:
-        with open(cache_filename, 'r') as dump:
+        with gzip.open(cache_filename, 'rb') as dump:
             display_step('load cache', cache_filename)
             logging.debug('(pic) loading cache file ...')
-            pname_candidate = cPickle.loads(dump.read())
+            cached = pickle.load(dump)
+            pname_candidate = {pname: (db_index.name_to_game[gname], path, file_crc, index) \
+                for pname, (gname, path, file_crc, index) in cached.items()}
             logging.debug('(pic) cache loaded!')
     except:
         logging.debug('(pic) error loading cache!')
 
     if pname_candidate is None:
-        pname_candidate = verify_paths(args.rompath, xml_root, regions, args.bios)
-        with open(cache_filename, 'w') as dump:
+        pname_candidate = verify_paths(args.rompath, db_index, regions, args.bios)
+        with gzip.open(cache_filename, 'wb') as dump:
             display_step('save cache', cache_filename)
             logging.debug('(pic) writing cache file ...')
-            dump.write(cPickle.dumps(pname_candidate))
+            cached = {pname: (game.name, path, file_crc, index) \
+                for pname, (game, path, file_crc, index) in pname_candidate.items()}
+            pickle.dump(cached, dump, pickle.HIGHEST_PROTOCOL)
             logging.debug('(pic) cache written!')
 
-    # generate the retroarch playlist
-    system_name = xml_root.find('.//header/name').text.split(' Parent-Clone')[0]
+    # generate the retroarch playlist, both the playlist and the romset are sorted by name
+    system_name = dat_name.split(' Parent-Clone')[0]
+    pnames = sorted(pname_candidate)
     if args.playlist:
         playlist_filename = system_name + ".lpl"
-        generate_playlist(pname_candidate, playlist_filename, args.prefix or '')
+        generate_playlist(pname_candidate, pnames, playlist_filename, args.prefix or '')
 
     # create the romset
     if args.romdir:
@@ -504,5 +844,5 @@ if __name__ == '__main__':
         romdir = system_name
         if not exists(romdir):
             makedirs(romdir)
-        create_romset(pname_candidate, romdir)
+        create_romset(pname_candidate, pnames, romdir, COMPRESSION_METHODS[args.compression])
 